@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+import atexit
+import cProfile
+import pstats
+import threading
+import time
+import tracemalloc
+
+from lib.log import *
+
+MAX_PROFILE_LINES = 25
+MAX_ALLOCATIONS = 10
+
+enabled = False
+profile_file = None
+phases = {}
+phases_lock = threading.Lock()
+local = threading.local()
+
+
+def set_profile(output=None):
+    """Enable phase timers and optionally dump detailed stats to output."""
+    global enabled
+    global profile_file
+    enabled = True
+    profile_file = output
+    if profile_file:
+        tracemalloc.start()
+    # report also when the tool stops by error()
+    atexit.register(report)
+
+
+def take_snapshot():
+    snapshot = tracemalloc.take_snapshot()
+    return snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+@contextmanager
+def phase(name):
+    """Measure the enclosed code as phase name."""
+    if not enabled:
+        yield
+        return
+
+    # phases of each thread are nested separately
+    active_phases = local.__dict__.setdefault('phases', [])
+    # only one cProfile can be active - nested phases and phases of
+    # background threads get timers only
+    detailed = (profile_file and not active_phases
+                and threading.current_thread() is threading.main_thread())
+    active_phases.append(name)
+    if detailed:
+        snapshot = take_snapshot()
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Python 3.9+ - on older versions the peak is measured since start
+            tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    wall_started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_started
+        cpu = time.thread_time() - cpu_started
+        active_phases.pop()
+        if detailed:
+            profiler.disable()
+            peak = tracemalloc.get_traced_memory()[1]
+            allocations = take_snapshot().compare_to(snapshot, 'lineno')[:MAX_ALLOCATIONS]
+
+        with phases_lock:
+            data = phases.setdefault(name, {
+                'count': 0,
+                'wall': 0.0,
+                'cpu': 0.0,
+                'max': 0.0,
+                'peak': 0,
+                'stats': None,
+                'allocations': [],
+            })
+            data['count'] += 1
+            data['wall'] += wall
+            data['cpu'] += cpu
+            data['max'] = max(data['max'], wall)
+
+            if detailed:
+                if data['stats']:
+                    data['stats'].add(profiler)
+                else:
+                    data['stats'] = pstats.Stats(profiler)
+                data['peak'] = max(data['peak'], peak)
+                # keep the allocations of the most recent run of this phase
+                data['allocations'] = allocations
+
+
+def format_summary():
+    lines = ['{:20} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'phase', 'count', 'total[s]', 'avg[s]', 'max[s]', 'cpu[s]', 'peak[KiB]')]
+    with phases_lock:
+        items = list(phases.items())
+    for name, data in items:
+        lines.append('{:20} {:7d} {:10.3f} {:10.3f} {:10.3f} {:10.3f} {:10.1f}'.format(
+            name, data['count'], data['wall'], data['wall'] / data['count'],
+            data['max'], data['cpu'], data['peak'] / 1024))
+    return lines
+
+
+def report():
+    if not phases:
+        return
+
+    info('Profile of phases:')
+    for line in format_summary():
+        info(line)
+
+    if not profile_file:
+        return
+    try:
+        with open(profile_file, 'w') as fd:
+            fd.write('\n'.join(format_summary()) + '\n')
+            with phases_lock:
+                items = list(phases.items())
+            for name, data in items:
+                if not data['stats']:
+                    continue
+                fd.write(f'\n=== {name} ===\n')
+                data['stats'].stream = fd
+                data['stats'].sort_stats('cumulative').print_stats(MAX_PROFILE_LINES)
+                fd.write(f'Top allocations (last run of {name}):\n')
+                for statistic in data['allocations']:
+                    fd.write(f'  {statistic}\n')
+        info('Profile data has been written to:', profile_file)
+    except OSError as e:
+        warning('Could not write profile data:', e)
@@ -0,0 +1,162 @@
+from collections import defaultdict
+from datetime import timedelta
+import atexit
+import bisect
+import gzip
+import json
+import threading
+import time
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from lib.log import *
+
+SCRUBBED_KEYS = ('password', 'local', 'token')
+SCRUBBED_VALUE = '***'
+
+
+class ReplayException(Exception):
+    pass
+
+
+def open_recording(filename, mode):
+    """Open a recording - files ending with .gz are compressed."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't')
+    return open(filename, mode)
+
+
+def scrub(data):
+    """Replace credentials and tokens in json data."""
+    if isinstance(data, dict):
+        return {key: SCRUBBED_VALUE if key in SCRUBBED_KEYS else scrub(value)
+                for key, value in data.items()}
+    if isinstance(data, list):
+        return [scrub(element) for element in data]
+    return data
+
+
+def scrub_body(body):
+    if not body:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    try:
+        return scrub(json.loads(body))
+    except json.decoder.JSONDecodeError:
+        return body
+
+
+def request_key(method, path, body):
+    return (method, path, json.dumps(body, sort_keys=True))
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Transport which writes all requests and responses to a file."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(**kwargs)
+        debug('Recording conductor traffic to:', filename)
+        self.fd = open_recording(filename, 'w')
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # keep the recording intact when the tool stops by error()
+        atexit.register(self.fd.close)
+
+    def send(self, request, **kwargs):
+        sent = time.time()
+        response = super().send(request, **kwargs)
+        entry = {
+            't': round(sent - self.started, 3),
+            'method': request.method,
+            'path': request.path_url,
+            'request': scrub_body(request.body),
+            'status': response.status_code,
+        }
+        try:
+            entry['response'] = scrub(response.json())
+        except ValueError:
+            entry['text'] = response.text
+        # response.elapsed is only set by the session after send() returns -
+        # measure the latency including the body here
+        entry['elapsed'] = round(time.time() - sent, 3)
+        with self.lock:
+            self.fd.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.fd.flush()
+        return response
+
+    def close(self):
+        super().close()
+        self.fd.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport which answers requests from a recording.
+
+    A request is answered by the latest response recorded for it up to the
+    current replay time. Responses are never returned
+    out of their recorded order: a request sent earlier than recorded gets
+    the next unused response. When they are exhausted, the last one is
+    repeated.
+    """
+
+    def __init__(self, filename, speed=1.0, clock=time.time):
+        super().__init__()
+        debug('Replaying conductor traffic from:', filename)
+        self.speed = speed
+        # clock of the replay - waiting time is skipped on accelerated
+        # replays, but processing time is not
+        self.clock = clock
+        self.lock = threading.Lock()
+        # replay time starts with the first request
+        self.started = None
+        self.first_recorded = None
+        self.responses = defaultdict(list)
+        self.times = defaultdict(list)
+        self.cursors = defaultdict(int)
+        with open_recording(filename, 'r') as fd:
+            for line in fd:
+                entry = json.loads(line)
+                key = request_key(entry['method'], entry['path'], entry['request'])
+                self.responses[key].append(entry)
+                self.times[key].append(entry['t'])
+                if self.first_recorded is None:
+                    self.first_recorded = entry['t']
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.path_url, scrub_body(request.body))
+        entries = self.responses.get(key)
+        if not entries:
+            raise ReplayException(
+                f'No recorded response for {request.method} {request.path_url}')
+        with self.lock:
+            if self.started is None:
+                self.started = self.clock()
+            now = self.clock() - self.started + self.first_recorded
+            index = bisect.bisect_right(self.times[key], now) - 1
+            index = min(max(index, self.cursors[key]), len(entries) - 1)
+            self.cursors[key] = index + 1
+        entry = entries[index]
+
+        # simulate the latency of the conductor - not skipped on the replay
+        # clock, as requests of several threads may overlap
+        time.sleep(entry['elapsed'] / self.speed)
+
+        response = Response()
+        response.status_code = entry['status']
+        if 'response' in entry:
+            body = json.dumps(entry['response'])
+        else:
+            body = entry.get('text', '')
+        response._content = body.encode('utf-8')
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=entry['elapsed'])
+        return response
+
+    def close(self):
+        pass
@@ -1,10 +1,14 @@
+from functools import partial
 import json
 import os
 import pathlib
 import requests
+import threading
 import time
 
 from lib.log import *
+from lib.profiling import phase
+from lib.recording import RecordingAdapter, ReplayAdapter
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -12,6 +16,7 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 RELEASE_CACHE_LOCATION = os.path.join(pathlib.Path.home(), '.{app}.release_cache')
 MAX_CACHE_AGE = 86400 # 1 day
 MAX_ASSETS_CACHE_TIME = 5
+ASSETS_FETCH_MARGIN = 1
 
 
 def get_unified_release(release_string):
@@ -26,6 +31,73 @@ class MissingNonceException(Exception):
     pass
 
 
+class AssetsRefresher(threading.Thread):
+    """Background thread which keeps a snapshot of all assets.
+
+    The snapshot is fetched again every interval seconds. The interval is
+    set by the latest request, and fetches are started so that they
+    complete right before the interval ends. Readers never wait for a
+    fetch, except for the very first one.
+    """
+
+    def __init__(self, api):
+        super().__init__(name='assets-refresher', daemon=True)
+        self.api = api
+        self.snapshot = []
+        # number of completed fetches
+        self.generation = 0
+        # start of the next fetch (None = not scheduled) and the refresh interval
+        self.start_at = None
+        self.interval = 0
+        # duration of the last fetch - used to finish fetches just in time
+        self.duration = 0
+        self.condition = threading.Condition()
+
+    def request(self, delay=0):
+        """Refresh the snapshot every delay seconds (once if delay is 0)."""
+        with self.condition:
+            self.interval = delay
+            self.start_at = self.api.clock() + max(delay - self.duration - ASSETS_FETCH_MARGIN, 0)
+            self.condition.notify_all()
+
+    def latest(self):
+        """Return the latest snapshot - waits only until the first fetch is done."""
+        with self.condition:
+            while not self.generation:
+                self.condition.wait()
+            return self.snapshot
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.start_at is None:
+                        self.condition.wait()
+                        continue
+                    remaining = self.start_at - self.api.clock()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining / self.api.time_scale)
+                # schedule the next periodic fetch
+                if self.interval:
+                    self.start_at += self.interval
+                else:
+                    self.start_at = None
+            started = self.api.clock()
+            try:
+                assets = self.api.fetch_assets()
+            except Exception as e:
+                warning('Could not refresh assets:', e)
+                assets = None
+            with self.condition:
+                if assets is not None:
+                    # swap the snapshot - readers keep their pinned list
+                    self.snapshot = assets
+                self.duration = self.api.clock() - started
+                self.generation += 1
+                self.condition.notify_all()
+
+
 class RestGraphqlApi(object):
     """Representation of REST/Graphql connection."""
 
@@ -36,8 +108,13 @@ class RestGraphqlApi(object):
     }
     assets = []
     assets_fetched_ts = 0
+    assets_refresher = None
+    replaying = False
+    time_scale = 1.0
+    skipped_time = 0
 
-    def __init__(self, host='localhost', verify=False, user='admin', password=None, app=__file__):
+    def __init__(self, host='localhost', verify=False, user='admin', password=None, app=__file__,
+                 record=None, replay=None, replay_speed=1.0):
         self.host = host
         self.verify = verify
         self.user = user
@@ -51,11 +128,41 @@ class RestGraphqlApi(object):
              'User-Agent': self.user_agent,
              'Authorization': f'Bearer {self.token}',
         })
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
-        self.session.hooks['response'].append(self.refresh_token)
         self.release_cache_location = RELEASE_CACHE_LOCATION.format(app=app)
-
+        self.adapter = None
+        if record:
+            self.adapter = RecordingAdapter(record)
+        if replay:
+            self.adapter = ReplayAdapter(replay, replay_speed, self.clock)
+            self.replaying = True
+            self.time_scale = replay_speed
+        self.clock_lock = threading.Lock()
+        self.token_lock = threading.RLock()
+        # assets are fetched with their own session (maybe by AssetsRefresher)
+        self.sessions = []
+        self.session = self.create_session()
+        self.assets_session = self.create_session()
+
+    def create_session(self):
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.hooks['response'].append(partial(self.refresh_token, session=session))
+        if self.adapter:
+            session.mount('https://', self.adapter)
+        self.sessions.append(session)
+        return session
+
+    def clock(self):
+        """Current time - includes the time skipped on accelerated replays."""
+        return time.time() + self.skipped_time
+
+    def sleep(self, seconds):
+        """Wait for seconds - on accelerated replays only a fraction of it."""
+        shortened = seconds / self.time_scale
+        # skip ahead first, so that the clock is not behind while waiting
+        with self.clock_lock:
+            self.skipped_time += seconds - shortened
+        time.sleep(shortened)
 
     def read_token(self):
         try:
@@ -66,18 +173,26 @@ class RestGraphqlApi(object):
             pass
 
     def write_token(self):
+        if self.replaying:
+            # do not overwrite the real token with a scrubbed one
+            return
         try:
             with open(self.token_file, 'w') as fd:
                 fd.write(self.token)
         except:
             raise
 
-    def refresh_token(self, r, *args, **kwargs):
+    def refresh_token(self, r, *args, session=None, **kwargs):
         if r.status_code == 401:
-            token = self.login()
-            self.session.headers.update({'Authorization': f'Bearer {token}'})
-            r.request.headers['Authorization'] = self.session.headers['Authorization']
-            return self.session.send(r.request, verify=self.verify)
+            with self.token_lock:
+                if r.request.headers.get('Authorization') == f'Bearer {self.token}':
+                    # token has not been refreshed by another session yet
+                    self.login()
+                authorization = f'Bearer {self.token}'
+                for s in self.sessions:
+                    s.headers.update({'Authorization': authorization})
+            r.request.headers['Authorization'] = authorization
+            return session.send(r.request, verify=self.verify)
 
     def get(self, location, **kwargs):
         """Get data per REST API."""
@@ -182,6 +297,8 @@ class RestGraphqlApi(object):
         if data:
             releases = [d['version'].replace('.el7', '') for d in data]
             # write releases to cache
+            if self.replaying:
+                return releases
             try:
                 with open(cache_location, 'w') as fd:
                     json.dump(releases, fd)
@@ -189,16 +306,47 @@ class RestGraphqlApi(object):
                 pass
         return releases
 
+    def fetch_assets(self):
+        url = 'https://{}/api/v1/asset?verbose=true'.format(self.host)
+        with phase('assets http'):
+            r = self.assets_session.get(url, verify=self.verify)
+        if r.status_code == 200:
+            with phase('assets decode'):
+                return r.json()
+
     def get_assets(self):
-        now = int(time.time())
+        if self.assets_refresher:
+            # never block on the conductor - use the pinned snapshot
+            return self.assets
+        now = int(self.clock())
         if now - self.assets_fetched_ts > MAX_ASSETS_CACHE_TIME:
-            location = '/asset?verbose=true'
-            r = self.get(location)
-            if r.status_code == 200:
-                self.assets = r.json()
+            assets = self.fetch_assets()
+            if assets is not None:
+                self.assets = assets
                 self.assets_fetched_ts = now
         return self.assets
 
+    def start_assets_refresher(self):
+        """Fetch assets in a background thread from now on."""
+        self.assets_refresher = AssetsRefresher(self)
+        self.assets_refresher.start()
+        self.refresh_assets()
+        self.pin_assets()
+
+    def refresh_assets(self, delay=0):
+        """Refresh the assets snapshot every delay seconds in the background.
+
+        Each fetch is started as late as possible, so that the snapshot
+        reflects the changes of the waiting time.
+        """
+        if self.assets_refresher:
+            self.assets_refresher.request(delay)
+
+    def pin_assets(self):
+        """Use the latest assets snapshot for all reads until the next call."""
+        if self.assets_refresher:
+            self.assets = self.assets_refresher.latest()
+
     def write_assets_data(self):
         with open('/tmp/assets.json', 'w') as fd:
             json.dump(self.assets, fd)
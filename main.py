@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import os
 import time
 
 from lib.log import *
+from lib.profiling import phase, set_profile
 from lib.rest import RestGraphqlApi, get_unified_release
 
 APP = 't128-bulk-upgrade'
 RUNNING_STATUSES = ('RUNNING', 'RESYNCHRONIZING')
+READY_STATUSES = ('DOWNLOAD_COMPLETED', 'DOWNLOAD_NOT_NEEDED')
 
 
 def is_positive(value):
@@ -19,6 +22,26 @@ def is_positive(value):
     return number
 
 
+def is_time_window(value):
+    try:
+        start, end = value.split('-')
+        window = []
+        for clock in (start, end):
+            hours, minutes = clock.split(':')
+            hours = int(hours)
+            minutes = int(minutes)
+            if not (0 <= hours < 24 and 0 <= minutes < 60):
+                raise ValueError
+            window.append(60 * hours + minutes)
+        if window[0] == window[1]:
+            # empty window
+            raise ValueError
+    except ValueError:
+        msg = '{} is not a valid time window (HH:MM-HH:MM)'.format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return tuple(window)
+
+
 def parse_arguments():
     """Get commandline arguments."""
     parser = argparse.ArgumentParser(
@@ -36,15 +59,19 @@ def parse_arguments():
     parser.add_argument('--password',
                         help='Conductor/router password (if no key auth)')
     parser.add_argument('--parallel', '-p', type=is_positive, default=1,
-                        help='Upgrade PARALLEL routers at the same time')
+                        help='Download/upgrade PARALLEL routers at the same time (0 = all)')
     parser.add_argument('--max', '-m', type=int,
                         help='Upgrade only MAX routers and then exit')
     parser.add_argument('--download-only', '-d', action='store_true',
                         help='Download new release but do not upgrade')
     parser.add_argument('--timeout', '-t', type=int, default=3600,
-                        help='Stop processing when one router is not finished within TIMEOUT seconds')
+                        help='Stop processing when one router is not finished within TIMEOUT seconds after its download/upgrade was issued')
     parser.add_argument('--download-timeout', type=int,
                         help='Define a different --timeout for downloads (default: use the same timeout for download and upgrade)')
+    parser.add_argument('--retries', type=is_positive, default=0,
+                        help='Move routers exceeding the timeout to the end of the queue and retry them up to RETRIES times')
+    parser.add_argument('--retry-download', action='store_true',
+                        help='Issue the download again when retrying a router that exceeded the download timeout')
     parser.add_argument('--filter', '-f', action='append',
                         help='Filter routers based on FILTER (name.list, name.startswith, name.contains, name.equals, version.startswith, version.equals)')
     parser.add_argument('--router-file',
@@ -63,6 +90,24 @@ def parse_arguments():
                         help='Ignore errors during download and continue with upgrades')
     parser.add_argument('--yum-cache-refresh', action='store_true',
                         help='Trigger "send command yum-cache-refresh" on target router before download')
+    parser.add_argument('--prestage', action='store_true',
+                        help='Download release in the background to all selected routers, report upgrade-ready routers and exit')
+    parser.add_argument('--prestage-window', type=is_time_window,
+                        help='Start pre-stage downloads only within local time window HH:MM-HH:MM (e.g. 22:00-06:00)')
+    parser.add_argument('--prestage-state',
+                        help='Keep pre-stage progress in file to resume across invocations')
+    parser.add_argument('--ready-file',
+                        help='Write upgrade-ready routers to file (can be used as --router-file)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Show time spent in each phase (startup, selection, rollout cycles, ...) on exit')
+    parser.add_argument('--profile-file',
+                        help='Write cProfile stats and top memory allocations per phase to file (implies --profile)')
+    parser.add_argument('--record',
+                        help='Record all requests to the conductor (without credentials) to file (.gz to compress)')
+    parser.add_argument('--replay',
+                        help='Replay conductor responses from a recording instead of connecting to the conductor')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Replay REPLAY_SPEED times faster than recorded (default: 1.0)')
     parser.add_argument('--version', action='version', version=f'{APP} 0.4')
     return parser.parse_args()
 
@@ -174,7 +219,7 @@ def select_routers(api, args):
 
 def write_status(router_status):
     try:
-        with open(status_file, 'w') as fd:
+        with open(status_file, 'w') as fd, phase('status write'):
             for router, status in router_status.items():
                 fd.write(f'{router:{max_len_router_name + 4}} {status}\n')
     except NameError:
@@ -182,157 +227,415 @@ def write_status(router_status):
         pass
 
 
-def download(api, routers, router_status, target, timeout, dry_run, ignore_errors=False, yum_cache_refresh=False):
-    download_started = time.time()
-    all_routers_ready_for_upgrade = False
-    first_loop = True
-    while not all_routers_ready_for_upgrade:
-        all_routers_ready_for_upgrade = True
-        for router, releases in api.get_downloaded_releases(routers).items():
-            # check if an upgrade is already in progress
-            status_data = api.get_router_status(router)
-            if not status_data:
-                # something went wrong - skip this router
-                continue
-            if len(status_data) <= 2:
-                statuses = [element[0] for element in status_data]
-                texts = '|'.join([element[1] for element in status_data])
-            else:
-                error('Status is undefined:', status_data)
-
-            if any([status == 'UPGRADING' for status in statuses]):
-                # ignore this router for download operation
-                router_status[router] = 'UPGRADE_IN_PROGRESS'
+def missed_deadline(api, router, started, timeout):
+    """Check if the current step of router is running longer than timeout."""
+    return router in started and api.clock() - started[router] > timeout
 
-            elif any([status == 'DOWNLOADING' for status in statuses]):
-                debug(f'Router {router} is downloading. Details: {texts}')
-                router_status[router] = 'DOWNLOAD_IN_PROGRESS'
-                all_routers_ready_for_upgrade = False
 
-            else:
-                releases = [get_unified_release(release) for release in releases]
-                if get_unified_release(target) not in releases:
-                    # found a router has not downloaded the target release yet
-                    all_routers_ready_for_upgrade = False
-                    debug('Downloaded releases on {}: {}'.format(router, releases))
-                    full_release = api.get_full_release(router, target)
-                    if not full_release:
-                        write_status(router_status)
-                        api.write_assets_data()
-                        message = f'Release {target} is not available on router {router}'
-                        router_status[router] = 'DOWNLOAD_NOT_POSSIBLE'
-                        if ignore_errors:
-                            warning(message)
-                            # ignore this router for further processing
-                            routers.remove(router)
-                        else:
-                            error(message)
-                    elif dry_run:
-                        debug('Argument --dry-run provided. Skipping downloads.')
-                        all_routers_ready_for_upgrade = True
-                    else:
-                        info('Downloading', full_release, 'to router', router, '...')
-                        if yum_cache_refresh:
-                            debug('Send command yum-cache-refresh to router', router)
-                            api.send_command_yum_cache_refresh(router)
-                        api.download_release(router, full_release)
-                        router_status[router] = 'DOWNLOAD_IN_PROGRESS'
+def download_step(api, router, router_status, target, first_check, dry_run,
+                  ignore_errors=False, yum_cache_refresh=False, reissue=False):
+    """Check and trigger the download of target on router.
 
-                elif first_loop:
-                    info(f'Download skipped on {router}')
-                    router_status[router] = 'DOWNLOAD_NOT_NEEDED'
+    Returns True when the router is ready for the upgrade, False while the
+    download is in progress and None when the router has to be skipped.
+    """
+    # check if an upgrade is already in progress
+    status_data = api.get_router_status(router)
+    if not status_data:
+        # something went wrong - check again in the next cycle
+        return False
+    if len(status_data) <= 2:
+        statuses = [element[0] for element in status_data]
+        texts = '|'.join([element[1] for element in status_data])
+    else:
+        error('Status is undefined:', status_data)
+
+    if any([status == 'UPGRADING' for status in statuses]):
+        # no download needed - the upgrade step waits for this router
+        router_status[router] = 'UPGRADE_IN_PROGRESS'
+        return True
+
+    if any([status == 'DOWNLOADING' for status in statuses]) and not reissue:
+        debug(f'Router {router} is downloading. Details: {texts}')
+        router_status[router] = 'DOWNLOAD_IN_PROGRESS'
+        return False
+
+    releases = api.get_downloaded_releases([router]).get(router, [])
+    releases = [get_unified_release(release) for release in releases]
+    if get_unified_release(target) in releases:
+        if first_check:
+            info(f'Download skipped on {router}')
+            router_status[router] = 'DOWNLOAD_NOT_NEEDED'
+        elif router_status.get(router) != 'DOWNLOAD_NOT_NEEDED':
+            info(f'Download of {target} on {router} has completed.')
+            router_status[router] = 'DOWNLOAD_COMPLETED'
+        return True
+
+    # found a router has not downloaded the target release yet
+    debug('Downloaded releases on {}: {}'.format(router, releases))
+    full_release = api.get_full_release(router, target)
+    if not full_release:
+        write_status(router_status)
+        api.write_assets_data()
+        message = f'Release {target} is not available on router {router}'
+        router_status[router] = 'DOWNLOAD_NOT_POSSIBLE'
+        if ignore_errors:
+            warning(message)
+            # ignore this router for further processing
+            return None
+        error(message)
+
+    if dry_run:
+        debug('Argument --dry-run provided. Skipping downloads.')
+        return None
+
+    info('Downloading', full_release, 'to router', router, '...')
+    if yum_cache_refresh:
+        debug('Send command yum-cache-refresh to router', router)
+        api.send_command_yum_cache_refresh(router)
+    api.download_release(router, full_release)
+    router_status[router] = 'DOWNLOAD_IN_PROGRESS'
+    return False
 
-                elif router_status.get(router) != 'DOWNLOAD_NOT_NEEDED':
-                    info(f'Download of {target} on {router} has completed.')
-                    router_status[router] = 'DOWNLOAD_COMPLETED'
 
-        write_status(router_status)
+def requeue_stragglers(stragglers, queue, attempts, retries):
+    """Move stragglers to the retry queue and return those without retries left."""
+    failed = []
+    for router in stragglers:
+        attempts[router] = attempts.get(router, 0) + 1
+        if attempts[router] <= retries:
+            info(f'Router {router} has been moved to the retry queue (retry {attempts[router]} of {retries}).')
+            queue.append(router)
+            continue
 
-        if not all_routers_ready_for_upgrade:
-            debug('Waiting 30 seconds until the next check if routers have downloaded the software...')
-            time.sleep(30)
+        warning(f'Router {router} did not finish within timeout after {attempts[router]} attempt(s).')
+        failed.append(router)
+    return failed
 
-        now = time.time()
-        if now - download_started > timeout:
-            message = f'Downloading current chunk took longer than {timeout} seconds.'
 
-            # set all routers that are still in progress to timed out
-            for router, status in router_status.items():
-                if status == 'DOWNLOAD_IN_PROGRESS':
-                    router_status[router] = 'DOWNLOAD_TIMED_OUT'
-                    # remove router since it cannot be upgraded anyways
-                    routers.remove(router)
-            write_status(router_status)
+def is_in_window(window):
+    if not window:
+        return True
+    start, end = window
+    now = time.localtime()
+    minutes = 60 * now.tm_hour + now.tm_min
+    if start <= end:
+        return start <= minutes < end
+    # window spans midnight (e.g. 22:00-06:00)
+    return minutes >= start or minutes < end
 
-            if ignore_errors:
-                warning(message)
-                return
-            else:
-                error(message)
 
-        first_loop = False
+def seconds_until_window(window):
+    start, _ = window
+    now = time.localtime()
+    minutes = (start - 60 * now.tm_hour - now.tm_min) % (24 * 60)
+    return max(60 * minutes - now.tm_sec, 1)
 
 
-def upgrade(api, routers, router_status, target, timeout, wait_running=False):
-    upgrade_done = {}
-    upgrade_started = time.time()
-    all_routers_done = False
-    while not all_routers_done:
-        all_routers_done = True
-        for router in routers:
-            # get router status
-            status_data = api.get_router_status(router)
-            if not status_data:
-                # something went wrong - skip this router
-                continue
-            if len(status_data) <= 2:
+def read_prestage_state(state_file, target):
+    try:
+        with open(state_file) as fd:
+            debug('Reading pre-stage state from:', state_file)
+            state = json.load(fd)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+    if state.get('release') != target:
+        # state belongs to another release - start from scratch
+        return {}
+    return state.get('routers', {})
+
+
+def write_prestage_state(state_file, target, router_status):
+    if not state_file:
+        return
+    with open(state_file, 'w') as fd:
+        json.dump({'release': target, 'routers': router_status}, fd, indent=2)
+
+
+def prestage(api, routers, router_status, target, parallel, timeout, retries=0,
+             window=None, state_file=None, dry_run=False, yum_cache_refresh=False):
+    unified_target = get_unified_release(target)
+    # downloads started by this run: deadline, cycle of the request and attempts
+    started = {}
+    issued_cycle = {}
+    attempts = {}
+    seen_downloading = set()
+    given_up = set()
+    cycle = 0
+    while True:
+        cycle += 1
+        with phase('prestage cycle'):
+            api.pin_assets()
+            in_flight = []
+            waiting = []
+            retry = []
+            # downloads given up by this run, which are still running
+            occupied = []
+            for router, releases in api.get_downloaded_releases(routers).items():
+                if router_status.get(router) == 'DOWNLOAD_NOT_POSSIBLE':
+                    # already failed before (maybe in a previous invocation)
+                    continue
+
+                status_data = api.get_router_status(router)
+                if not status_data:
+                    # something went wrong - skip this router
+                    continue
                 statuses = [element[0] for element in status_data]
-                texts = '|'.join([element[1] for element in status_data])
-            else:
-                error('Status is undefined:', status_data)
-
-            if any([status == 'UPGRADING' for status in statuses]):
-                debug(f'Router {router} is upgrading. Details: {texts}')
-                router_status[router] = 'UPGRADE_IN_PROGRESS'
-                all_routers_done = False
 
-            elif api.get_running_release(router) != get_unified_release(target):
-                # router not yet done
-                all_routers_done = False
+                if router in given_up:
+                    # a download which has been given up still uses its slot
+                    if any([status == 'DOWNLOADING' for status in statuses]):
+                        occupied.append(router)
+                    continue
 
-                if all([status == 'RUNNING' for status in statuses]):
-                    debug(f'Router {router} is in state RUNNING. Upgrading it.')
+                releases = [get_unified_release(release) for release in releases]
+                if unified_target in releases:
+                    if router_status.get(router) == 'DOWNLOAD_IN_PROGRESS':
+                        info(f'Download of {target} on {router} has completed.')
+                        router_status[router] = 'DOWNLOAD_COMPLETED'
+                    elif router_status.get(router) not in READY_STATUSES:
+                        debug(f'Router {router} has already downloaded {target}.')
+                        router_status[router] = 'DOWNLOAD_NOT_NEEDED'
+                    continue
+
+                if any([status == 'UPGRADING' for status in statuses]):
+                    # ignore this router for download operation
+                    router_status[router] = 'UPGRADE_IN_PROGRESS'
+                    continue
+
+                if any([status == 'DOWNLOADING' for status in statuses]):
+                    router_status[router] = 'DOWNLOAD_IN_PROGRESS'
+                    seen_downloading.add(router)
+                    started.setdefault(router, api.clock())
+                elif (router in issued_cycle and router not in seen_downloading
+                      and cycle - issued_cycle[router] <= 1):
+                    # download was requested recently, but is not visible yet
+                    pass
+                else:
+                    if router in started:
+                        warning(f'Download of {target} on {router} has stopped without success.')
+                        del started[router]
+                        seen_downloading.discard(router)
+                    if attempts.get(router, 0) > retries:
+                        warning(f'Download on router {router} failed after {attempts[router]} attempt(s).')
+                        router_status[router] = 'DOWNLOAD_FAILED'
+                        given_up.add(router)
+                    else:
+                        waiting.append(router)
+                    continue
+
+                if missed_deadline(api, router, started, timeout):
+                    if attempts.get(router, 0) > retries:
+                        warning(f'Download on router {router} took longer than {timeout} seconds.')
+                        router_status[router] = 'DOWNLOAD_TIMED_OUT'
+                        given_up.add(router)
+                        occupied.append(router)
+                        continue
+                    # issue the download again - the router keeps its slot
+                    retry.append(router)
+                in_flight.append(router)
+
+            if dry_run:
+                for router in waiting:
+                    debug(f'Argument --dry-run provided. Skipping download on {router}.')
+                break
+
+            if not waiting and not in_flight:
+                break
+
+            if not is_in_window(window):
+                debug('Outside of pre-stage window. No new downloads are started.')
+            else:
+                # keep at most PARALLEL downloads in flight (0 = unlimited)
+                slots = len(waiting)
+                if parallel:
+                    slots = max(parallel - len(in_flight) - len(occupied), 0)
+                for router in retry:
+                    warning(f'Download on router {router} took longer than {timeout} seconds. '
+                            f'Issuing it again (attempt {attempts.get(router, 0) + 1} of {retries + 1}).')
+                for router in retry + waiting[:slots]:
                     full_release = api.get_full_release(router, target)
                     if not full_release:
-                        write_status(router_status)
-                        api.write_assets_data()
-                        message = 'Release', target, 'is not available on router', router
-                        error(message)
-                    info('Upgrading router', router, 'to release', full_release, '...')
-                    api.upgrade_router(router, full_release)
+                        warning(f'Release {target} is not available on router {router}')
+                        router_status[router] = 'DOWNLOAD_NOT_POSSIBLE'
+                        continue
+                    info('Pre-staging', full_release, 'on router', router, '...')
+                    if yum_cache_refresh:
+                        debug('Send command yum-cache-refresh to router', router)
+                        api.send_command_yum_cache_refresh(router)
+                    api.download_release(router, full_release)
+                    router_status[router] = 'DOWNLOAD_IN_PROGRESS'
+                    started[router] = api.clock()
+                    issued_cycle[router] = cycle
+                    seen_downloading.discard(router)
+                    attempts[router] = attempts.get(router, 0) + 1
+
+            write_status(router_status)
+            write_prestage_state(state_file, target, router_status)
 
-                if all([status == 'DISCONNECTED' for status in statuses]):
-                    debug(f'Router {router} is DISCONNECTED. Waiting for it to come back online.')
+        if not in_flight and not is_in_window(window):
+            # nothing to monitor - do not poll the conductor until the window opens
+            wait = seconds_until_window(window)
+            debug(f'{len(waiting)} routers waiting. Waiting {wait} seconds until the pre-stage window opens...')
+        else:
+            wait = 30
+            debug(f'{len(in_flight)} downloads in progress, {len(waiting)} routers waiting. '
+                  f'Waiting {wait} seconds until the next check...')
+        # the next snapshot should show the changes of the waiting time
+        api.refresh_assets(wait)
+        with phase('sleep'):
+            api.sleep(wait)
+
+    write_status(router_status)
+    write_prestage_state(state_file, target, router_status)
+    return [router for router in routers if router_status.get(router) in READY_STATUSES]
+
+
+def upgrade_step(api, router, router_status, target, wait_running=False):
+    """Check and trigger the upgrade of router and return True when it is done."""
+    # get router status
+    status_data = api.get_router_status(router)
+    if not status_data:
+        # something went wrong - check again in the next cycle
+        return False
+    if len(status_data) <= 2:
+        statuses = [element[0] for element in status_data]
+        texts = '|'.join([element[1] for element in status_data])
+    else:
+        error('Status is undefined:', status_data)
+
+    if any([status == 'UPGRADING' for status in statuses]):
+        debug(f'Router {router} is upgrading. Details: {texts}')
+        router_status[router] = 'UPGRADE_IN_PROGRESS'
+        return False
+
+    if api.get_running_release(router) != get_unified_release(target):
+        # router not yet done
+        if all([status == 'RUNNING' for status in statuses]):
+            debug(f'Router {router} is in state RUNNING. Upgrading it.')
+            full_release = api.get_full_release(router, target)
+            if not full_release:
+                write_status(router_status)
+                api.write_assets_data()
+                message = 'Release', target, 'is not available on router', router
+                error(message)
+            info('Upgrading router', router, 'to release', full_release, '...')
+            api.upgrade_router(router, full_release)
+
+        if all([status == 'DISCONNECTED' for status in statuses]):
+            debug(f'Router {router} is DISCONNECTED. Waiting for it to come back online.')
+        return False
+
+    if wait_running and any([status not in RUNNING_STATUSES for status in statuses]):
+        # router is not in RUNNING state, but already upgraded -> wait
+        debug(f'Router {router} was upgraded. Waiting for it to get into RUNNING state.')
+        return False
+
+    if router_status.get(router) != 'UPGRADE_COMPLETED':
+        router_status[router] = 'UPGRADE_COMPLETED'
+        info(f'Upgrade of router {router} has completed.')
+    return True
+
+
+def start_router(api, router, router_status, target):
+    """Check if router needs an upgrade when it gets a slot."""
+    running = api.get_running_release(router)
+    if not running:
+        warning('Could not retrieve running version for router:', router)
+        router_status[router] = 'UNKNOWN'
+        return False
+    if is_older_release(running, target):
+        info(f'Router {router} is running version {running} and will be upgraded.')
+        return True
+    if router_status.get(router) == 'UPGRADE_TIMED_OUT':
+        info(f'Router {router} is now running version {running}.')
+        router_status[router] = 'UPGRADE_COMPLETED'
+    else:
+        info(f'Router {router} is already running version {running}. Skipping it.')
+        router_status[router] = 'NOOP'
+    return False
 
-            elif wait_running and any([status not in RUNNING_STATUSES for status in statuses]):
-                # router is not in RUNNING state, but already upgraded -> wait
-                debug(f'Router {router} was upgraded. Waiting for it to get into RUNNING state.')
-                all_routers_done = False
 
-            else:
-                if router_status.get(router) != 'UPGRADE_COMPLETED':
-                    router_status[router] = 'UPGRADE_COMPLETED'
-                    info(f'Upgrade of router {router} has completed.')
+def rollout(api, queue, router_status, args):
+    """Download and upgrade routers with at most PARALLEL routers in progress.
+
+    A router leaves its slot as soon as it is done or has missed its
+    deadline, and the slot is given to the next router in the queue.
+    Returns the routers which did not finish within timeout.
+    """
+    download_timeout = (args.download_timeout or args.timeout)
+    # current step of each router in progress and when it was started
+    active = {}
+    started = {}
+    attempts = {}
+    reissue = set()
+    stragglers = []
+    while queue or active:
+        with phase('rollout cycle'):
+            api.pin_assets()
+            # fill free slots (0 = unlimited)
+            while queue and (not args.parallel or len(active) < args.parallel):
+                router = queue.pop(0)
+                if start_router(api, router, router_status, args.release):
+                    active[router] = 'download'
+
+            for router, step in list(active.items()):
+                if step == 'download':
+                    first_check = router not in started
+                    # per router deadline - counted from when the download was issued
+                    started.setdefault(router, api.clock())
+                    ready = download_step(api, router, router_status, args.release,
+                                          first_check, args.dry_run, args.ignore_download_errors,
+                                          args.yum_cache_refresh, first_check and router in reissue)
+                    if first_check:
+                        reissue.discard(router)
+                    if ready is None:
+                        del active[router]
+                        del started[router]
+                        continue
+                    if not ready:
+                        if missed_deadline(api, router, started, download_timeout):
+                            warning(f'Download on router {router} took longer than {download_timeout} seconds.')
+                            router_status[router] = 'DOWNLOAD_TIMED_OUT'
+                            del active[router]
+                            del started[router]
+                            if args.retry_download:
+                                reissue.add(router)
+                            failed = requeue_stragglers([router], queue, attempts, args.retries)
+                            if not args.ignore_download_errors:
+                                stragglers.extend(failed)
+                        continue
+
+                    if args.download_only or args.dry_run:
+                        debug(f'Argument --download-only/--dry-run provided. Skipping upgrade of {router}.')
+                        del active[router]
+                        del started[router]
+                        continue
+                    # per router deadline - counted from when the upgrade was issued
+                    active[router] = 'upgrade'
+                    started[router] = api.clock()
+
+                if upgrade_step(api, router, router_status, args.release, args.wait_running):
+                    del active[router]
+                    del started[router]
+                elif missed_deadline(api, router, started, args.timeout):
+                    warning(f'Upgrade of router {router} took longer than {args.timeout} seconds.')
+                    router_status[router] = 'UPGRADE_TIMED_OUT'
+                    del active[router]
+                    del started[router]
+                    stragglers.extend(requeue_stragglers([router], queue, attempts, args.retries))
 
-        write_status(router_status)
+            write_status(router_status)
 
-        if not all_routers_done:
-            debug('Waiting 30 seconds until the next check if routers are upgraded...')
-            time.sleep(30)
+        if active:
+            debug(f'{len(active)} routers in progress, {len(queue)} routers waiting. '
+                  'Waiting 30 seconds until the next check...')
+            # the next snapshot should show the changes of the waiting time
+            api.refresh_assets(30)
+            with phase('sleep'):
+                api.sleep(30)
 
-        now = time.time()
-        if now - upgrade_started > timeout:
-            error(f'Upgrading current chunk took longer than {timeout} seconds.')
+    return stragglers
 
 
 def main():
@@ -343,6 +646,9 @@ def main():
     if args.debug:
         set_debug(APP)
 
+    if args.profile or args.profile_file:
+        set_profile(args.profile_file)
+
     # do not use a proxy server for localhost connections
     os.environ['no_proxy'] = 'localhost'
 
@@ -352,20 +658,36 @@ def main():
         if args.user and args.password:
             params['user'] = args.user
             params['password'] = args.password
-
-    api = RestGraphqlApi(**params, app=APP)
-
-    releases = filter_releases(api.get_upgrade_versions())
-    if args.list_releases:
-        info('Available releases:')
-        for release in releases:
-            print(' *', release)
-        return
-
-    if is_older_release(api.get_conductor_version(), args.release):
-        error('The specified release must not be newer than conductor running.')
-
-    routers = select_routers(api, args)
+    if args.record and args.replay:
+        error('The arguments --record and --replay cannot be combined.')
+    if args.replay_speed <= 0:
+        error('The replay speed must be greater than zero.')
+    if args.record:
+        params['record'] = args.record
+    if args.replay:
+        params['replay'] = args.replay
+        params['replay_speed'] = args.replay_speed
+
+    with phase('startup'):
+        api = RestGraphqlApi(**params, app=APP)
+
+        # recordings should contain all requests - do not use the release cache
+        cached = not (args.record or args.replay)
+        releases = filter_releases(api.get_upgrade_versions(cached))
+        if args.list_releases:
+            info('Available releases:')
+            for release in releases:
+                print(' *', release)
+            return
+
+        if is_older_release(api.get_conductor_version(), args.release):
+            error('The specified release must not be newer than conductor running.')
+
+        # from now on assets are fetched in the background
+        api.start_assets_refresher()
+
+    with phase('selection'):
+        routers = select_routers(api, args)
     if not routers:
         error('Could not find matching routers to upgrade.')
 
@@ -378,55 +700,33 @@ def main():
         max_len_router_name = max([len(router) for router in routers])
     router_status = {}
     debug('All matching routers:', ', '.join(routers[:args.max]))
-    start = 0
-    end = 0
-    maximum = (args.max or len(routers))
-    # iterate over routers up to maximum or all routers if no max given
-    while end < maximum:
-        if args.parallel:
-            end = min(end + args.parallel, maximum)
-        else:
-            end = maximum
-        chunk = list(routers[start:end])
-        info('Processing routers in this chunk:', ', '.join(chunk))
-        chunk_not_upgraded = []
-        for router in chunk:
-            running = api.get_running_release(router)
-            if not running:
-                warning('Could not retrieve running version for router:', router)
-                router_status[router] = 'UNKNOWN'
-                continue
-            if is_older_release(running, args.release):
-                info(f'Router {router} is running version {running} and will be upgraded.')
-                chunk_not_upgraded.append(router)
-            else:
-                info(f'Router {router} is already running version {running}. Skipping it.')
-                router_status[router] = 'NOOP'
 
-        write_status(router_status)
-        if chunk_not_upgraded:
-            download_timeout = (args.download_timeout or args.timeout)
-            download(api, chunk_not_upgraded, router_status, args.release,
-                     download_timeout, args.dry_run, args.ignore_download_errors, args.yum_cache_refresh)
-            write_status(router_status)
-            debug(f'All {len(chunk_not_upgraded)} routers in the chunk are ready for the upgrade.')
-
-            if args.download_only:
-                debug('Argument --download-only provided. Skipping upgrades.')
-            elif args.dry_run:
-                debug('Argument --dry-run provided. Skipping upgrades.')
-            else:
-                upgrade(api, chunk_not_upgraded, router_status, args.release,
-                        args.timeout, args.wait_running)
-                write_status(router_status)
-            info('Chunk has been completed.')
-        else:
-            # nothing to do in this chunk
-            info('No routers to be upgraded in this chunk.')
-
-        if args.parallel:
-            start += args.parallel
+    if args.prestage:
+        routers = routers[:args.max]
+        if args.prestage_state:
+            for router, status in read_prestage_state(args.prestage_state, args.release).items():
+                if router in routers:
+                    router_status[router] = status
+        download_timeout = (args.download_timeout or args.timeout)
+        ready = prestage(api, routers, router_status, args.release, args.parallel,
+                         download_timeout, args.retries, args.prestage_window,
+                         args.prestage_state, args.dry_run, args.yum_cache_refresh)
+        info(f'{len(ready)} of {len(routers)} routers are ready for the upgrade to {args.release}.')
+        for router in routers:
+            if router not in ready:
+                info(f'Router {router} is not ready: {router_status.get(router, "UNKNOWN")}')
+        if args.ready_file:
+            with open(args.ready_file, 'w') as fd:
+                for router in ready:
+                    fd.write(f'{router}\n')
+        return
 
+    # stragglers are appended again to the end of the queue
+    stragglers = rollout(api, routers[:args.max], router_status, args)
+    if stragglers:
+        for router in stragglers:
+            info(f'Router {router} did not finish: {router_status.get(router, "UNKNOWN")}')
+        error(f'{len(stragglers)} routers did not finish within timeout.')
 
 if __name__ == '__main__':
     main()